@@ -0,0 +1,372 @@
+"""
+Des 聊天记录数据库
+@Author thetheOrange
+Time 2024/5/5
+"""
+import time
+
+from contextlib import contextmanager
+from datetime import datetime
+from enum import Enum
+
+from sqlalchemy import create_engine, event, select, insert, delete, func, text, Column, Integer, SmallInteger, \
+    String, Text, DateTime, ForeignKey, Index, TypeDecorator
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import declarative_base, relationship, selectinload, sessionmaker
+from sqlalchemy.pool import QueuePool
+
+from Logging import app_logger
+
+Base = declarative_base()
+
+
+class SenderType(Enum):
+    """
+    消息发送者类型
+    """
+    USER = 0
+    ASSISTANT = 1
+
+
+class IntEnum(TypeDecorator):
+    """
+    以枚举的整数值落库为SmallInteger 行宽比VARCHAR枚举更小 比较也更快
+    """
+    impl = SmallInteger
+    cache_ok = True
+
+    def __init__(self, enum_cls, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._enum_cls = enum_cls
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        # 兼容传入"user"/"assistant"字符串的旧调用方
+        if isinstance(value, str):
+            return self._enum_cls[value.upper()].value
+        return value.value
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return self._enum_cls(value)
+
+
+class Mask(Base):
+    """
+    预设面具表
+    """
+    __tablename__ = "mask"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    # 面具名
+    mask_name = Column(String(50), unique=True, nullable=False)
+    # 面具对应的预设提示词
+    mask_content = Column(Text, default="")
+
+    dialogues = relationship("Dialogue", back_populates="mask")
+
+
+class Dialogue(Base):
+    """
+    对话表
+    """
+    __tablename__ = "dialogue"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    # 对话名
+    dialogue_name = Column(String(50), unique=True, nullable=False)
+    # 对话使用的面具
+    mask_id = Column(Integer, ForeignKey("mask.id"))
+
+    mask = relationship("Mask", back_populates="dialogues")
+    messages = relationship("Message", back_populates="dialogue")
+
+    def __format__(self, format_spec: str) -> str:
+        match format_spec:
+            case "history":
+                # 生成器直接喂给join 不额外构造一份完整列表
+                return "\n".join(f"{message.sender.name.lower()}: {message.message}"
+                                 for message in self.messages)
+            case _:
+                raise ValueError("Unknown format specifier")
+
+
+class Message(Base):
+    """
+    消息表
+    """
+    __tablename__ = "message"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    # 消息所属的对话
+    dialogue_name = Column(String(50), ForeignKey("dialogue.dialogue_name"), index=True)
+    # 消息的发送者 用户或ai
+    sender = Column(IntEnum(SenderType), nullable=False)
+    # 消息内容
+    message = Column(Text, nullable=False)
+    # 消息的发送时间 由数据库侧的CURRENT_TIMESTAMP填充
+    send_time = Column(DateTime, server_default=func.now(), nullable=False)
+
+    dialogue = relationship("Dialogue", back_populates="messages")
+
+    # 覆盖按对话取最新N条消息的查询 使ORDER BY id DESC LIMIT N走索引扫描
+    __table_args__ = (Index("ix_msg_dialogue_id", "dialogue_name", "id"),)
+
+
+class ChatSql:
+    """
+    聊天记录数据库操作
+    """
+
+    def __init__(self, db_path: str = "chat.db"):
+        # 数据库文件的位置
+        self.db_path: str = db_path
+        # QueuePool复用连接避免每次调用重新建连 且每个会话独占一条连接
+        # 并发会话互不干扰 pragma由connect监听器在每条连接上重放
+        # insertmanyvalues分页控制单条INSERT的参数个数 避免大批量插入超出SQLite的变量上限
+        self.engine = create_engine(f"sqlite:///{self.db_path}",
+                                    future=True,
+                                    poolclass=QueuePool,
+                                    connect_args={"check_same_thread": False, "timeout": 30},
+                                    insertmanyvalues_page_size=500,
+                                    query_cache_size=1200)
+
+        if self.db_path != ":memory:":
+            # 开启WAL日志模式 使读写可以并发进行 每次commit只需一次顺序追加写
+            # 对每个池化连接都重复执行 保证pragma幂等生效
+            @event.listens_for(self.engine, "connect")
+            def _set_sqlite_pragma(dbapi_connection, connection_record) -> None:
+                cursor = dbapi_connection.cursor()
+                cursor.execute("PRAGMA journal_mode=WAL")
+                cursor.execute("PRAGMA synchronous=NORMAL")
+                cursor.execute("PRAGMA temp_store=MEMORY")
+                cursor.execute("PRAGMA mmap_size=268435456")
+                cursor.execute("PRAGMA cache_size=-20000")
+                cursor.execute("PRAGMA foreign_keys=ON")
+                cursor.close()
+
+        Base.metadata.create_all(self.engine)
+        # expire_on_commit=False 避免commit后再次查询以刷新已加载的对象
+        self.DB_session = sessionmaker(bind=self.engine, expire_on_commit=False)
+        # 保证默认面具存在 并缓存其id 免去每次建对话都查一遍
+        self._ensure_default_mask()
+
+    def _ensure_default_mask(self) -> None:
+        """
+        幂等地保证默认面具存在 并缓存其id
+
+        INSERT OR IGNORE在唯一索引上一次B树探测即完成存在性检查
+        不产生失败INSERT加回滚 也不污染日志
+        """
+        with self.engine.begin() as conn:
+            conn.execute(insert(Mask).prefix_with("OR IGNORE")
+                         .values(mask_name="default", mask_content=""))
+            self._default_mask_id: int = conn.scalar(select(Mask.id)
+                                                     .where(Mask.mask_name == "default"))
+
+    def add_mask(self, mask_name: str, mask_content: str = "") -> None:
+        """
+        新增一个面具 依赖唯一约束过滤重名
+
+        :param mask_name: 面具名
+        :param mask_content: 面具对应的预设提示词
+        :return:
+        """
+        try:
+            with self.DB_session() as session:
+                # 已存在同名面具则直接返回 避免依赖唯一约束失败带来的无谓INSERT和回滚
+                if session.scalar(select(Mask.mask_name)
+                                  .where(Mask.mask_name == mask_name)) is not None:
+                    return
+                mask = Mask(mask_name=mask_name, mask_content=mask_content)
+                session.add(mask)
+                session.commit()
+        except (IntegrityError, OperationalError) as e:
+            app_logger.error(f"[CHAT SQL] ERROR: {e}")
+
+    def create_dialogue(self, dialogue_name: str, mask_name: str = "default") -> None:
+        """
+        新建一个对话
+
+        :param dialogue_name: 对话名
+        :param mask_name: 对话使用的面具名
+        :return:
+        """
+        try:
+            with self.DB_session() as session:
+                # 不存在同名对话才创建 Query对象恒为真 必须真正取值判断
+                if session.scalar(select(Dialogue.dialogue_name)
+                                  .where(Dialogue.dialogue_name == dialogue_name)) is None:
+                    # 默认面具直接使用缓存的id
+                    if mask_name == "default":
+                        mask_id = self._default_mask_id
+                    else:
+                        mask_id = session.scalar(select(Mask.id)
+                                                 .where(Mask.mask_name == mask_name))
+                        # 面具名不存在时不能悄悄建出无面具的对话
+                        if mask_id is None:
+                            app_logger.error(f"[CHAT SQL] unknown mask: {mask_name}")
+                            return
+                    dialogue = Dialogue(dialogue_name=dialogue_name, mask_id=mask_id)
+                    session.add(dialogue)
+                    session.commit()
+        except (IntegrityError, OperationalError) as e:
+            app_logger.error(f"[CHAT SQL] ERROR: {e}")
+
+    @contextmanager
+    def batch(self):
+        """
+        批量写入上下文 在单个BEGIN IMMEDIATE事务内累积全部插入 退出时只commit一次
+
+        用法: with sql.batch() as session: sql.add_message(..., session=session)
+
+        批内任一插入失败会上抛异常 整个事务回滚 不会提交半截批次
+        批内的读操作使用各自的连接 看不到尚未提交的批内写入
+        """
+        session = self.DB_session()
+        # 立即取写锁 避免事务中途升级锁时和其他写入方死锁
+        session.execute(text("BEGIN IMMEDIATE"))
+        try:
+            yield session
+            session.commit()
+        finally:
+            session.close()
+
+    def add_message(self, dialogue_name: str, sender: str, message: str,
+                    send_time: datetime | None = None, session=None) -> int | None:
+        """
+        向指定对话中新增一条消息
+
+        :param dialogue_name: 消息所属的对话名
+        :param sender: 消息的发送者 用户或ai
+        :param message: 消息内容
+        :param send_time: 消息的发送时间 缺省时由数据库填充当前时间
+        :param session: batch()上下文中传入的会话 复用其事务
+        :return: 新插入消息的id 插入失败时为None
+        """
+        item: dict = {"sender": sender, "message": message}
+        if send_time is not None:
+            item["send_time"] = send_time
+        ids = self.add_messages(dialogue_name, [item], session=session)
+        return ids[0] if ids else None
+
+    def add_messages(self, dialogue_name: str, items: list, session=None) -> list:
+        """
+        向指定对话中批量新增消息 只查询一次对话 单事务单executemany完成插入
+
+        :param dialogue_name: 消息所属的对话名
+        :param items: 消息字典列表 每项包含sender和message 可选send_time
+        :param session: batch()上下文中传入的会话 复用其事务 由batch负责commit
+        :return: 新插入消息的id列表 与items顺序一致
+        """
+        # batch()事务内只写入不提交
+        own_session: bool = session is None
+        try:
+            if own_session:
+                session = self.DB_session()
+            try:
+                did = session.scalar(select(Dialogue.dialogue_name)
+                                     .where(Dialogue.dialogue_name == dialogue_name))
+                if did is None:
+                    return []
+                # RETURNING直接带回自增id 省掉插入后为拿id的一次SELECT
+                # sort_by_parameter_order保证返回顺序与items一致 RETURNING本身不承诺顺序
+                stmt = insert(Message).returning(Message.id, sort_by_parameter_order=True)
+                rows: list = [{"dialogue_name": did, **item} for item in items]
+                if not own_session:
+                    return session.scalars(stmt, rows).all()
+                # WAL下写锁升级冲突立即报database is locked 不等busy超时
+                # commit失败后事务已失效 必须rollback丢弃本次插入再整体重试
+                for attempt in range(3):
+                    try:
+                        ids: list = session.scalars(stmt, rows).all()
+                        session.commit()
+                        return ids
+                    except OperationalError as e:
+                        # 先回滚 保证连接不会带着未提交事务回到连接池
+                        session.rollback()
+                        if "locked" not in str(e) or attempt == 2:
+                            raise
+                        time.sleep(0.05 * (attempt + 1))
+            finally:
+                if own_session:
+                    session.close()
+        except (IntegrityError, OperationalError) as e:
+            # batch()事务内的失败必须上抛 由batch整体回滚 不能提交半截批次
+            if not own_session:
+                raise
+            app_logger.error(f"[CHAT SQL] ERROR: {e}")
+            return []
+
+    def get_messages(self, dialogue_name: str, limit: int = 30) -> list:
+        """
+        获取指定对话中最新的消息
+
+        :param dialogue_name: 对话名
+        :param limit: 消息条数上限
+        :return: 按时间倒序排列的消息列表
+        """
+        try:
+            with self.DB_session() as session:
+                # 由SQL完成排序和截断 避免加载整个对话的消息后在Python侧丢弃
+                return list(session.scalars(select(Message)
+                                            .where(Message.dialogue_name == dialogue_name)
+                                            .order_by(Message.id.desc())
+                                            .limit(limit)))
+        except (IntegrityError, OperationalError) as e:
+            app_logger.error(f"[CHAT SQL] ERROR: {e}")
+            return []
+
+    def delete_mask(self, mask_name: str) -> None:
+        """
+        删除指定的面具 直接下发DELETE 不先加载ORM对象
+
+        :param mask_name: 面具名
+        :return:
+        """
+        try:
+            with self.DB_session() as session:
+                session.execute(delete(Mask).where(Mask.mask_name == mask_name))
+                session.commit()
+        except (IntegrityError, OperationalError) as e:
+            app_logger.error(f"[CHAT SQL] ERROR: {e}")
+
+    def delete_dialogue(self, dialogue_name: str) -> None:
+        """
+        删除指定的对话及其全部消息
+
+        :param dialogue_name: 对话名
+        :return:
+        """
+        try:
+            with self.DB_session() as session:
+                session.execute(delete(Message).where(Message.dialogue_name == dialogue_name))
+                session.execute(delete(Dialogue).where(Dialogue.dialogue_name == dialogue_name))
+                session.commit()
+        except (IntegrityError, OperationalError) as e:
+            app_logger.error(f"[CHAT SQL] ERROR: {e}")
+
+    def get_dialogue(self) -> list:
+        """
+        获取所有的对话
+
+        :return: 对话列表
+        """
+        try:
+            with self.DB_session() as session:
+                # selectinload一次性取回全部消息 __format__访问messages时不再逐对话懒加载
+                return list(session.scalars(select(Dialogue)
+                                            .options(selectinload(Dialogue.messages))))
+        except (IntegrityError, OperationalError) as e:
+            app_logger.error(f"[CHAT SQL] ERROR: {e}")
+            return []
+
+
+if __name__ == "__main__":
+    sql = ChatSql()
+    sql.create_dialogue("test")
+    sql.add_messages("test", [{"sender": "user", "message": f"hello {i}"} for i in range(30)])
+    for msg in sql.get_messages("test"):
+        print(msg.sender, msg.message)
@@ -0,0 +1,23 @@
+import os
+
+from Core.ChatSql import ChatSql
+
+sql = ChatSql("test_chat.db")
+
+sql.add_mask("test_mask", "you are a helpful assistant")
+sql.create_dialogue("test")
+
+sql.add_message("test", "user", "hello")
+sql.add_messages("test", [{"sender": "user", "message": f"hello {i}"} for i in range(30)])
+
+for msg in sql.get_messages("test"):
+    print(msg.sender, msg.message, msg.send_time)
+
+for dialogue in sql.get_dialogue():
+    print(dialogue.dialogue_name)
+
+# 先关闭连接池再清理 否则WAL的-wal/-shm附属文件会残留
+sql.engine.dispose()
+for suffix in ("", "-wal", "-shm"):
+    if os.path.exists(f"test_chat.db{suffix}"):
+        os.remove(f"test_chat.db{suffix}")